@@ -1,3 +1,4 @@
+import os
 from typing import List
 
 import tensorflow as tf
@@ -17,9 +18,30 @@ def get_dataset_from_tfrecords(
     Returns a dataset that includes batching, but not gradient accumulation.
     """
 
-    def _parse_function(example_proto):
-        # Parse the input `tf.Example` proto using the dictionary above.
-        return tf.io.parse_single_example(example_proto, name_to_features)
+    def _parse_function(example_protos):
+        # Parse a batch of input `tf.Example` protos using the dictionary above.
+        features = tf.io.parse_example(example_protos, name_to_features)
+        if model_type in ["electra"]:
+            features = _decode_electra_features(features)
+        return features
+
+    def _decode_electra_features(features):
+        """ input_ids and token_type_ids are raw int32, attention_mask is packed 8 bits to a byte. """
+        shape = [per_gpu_batch_size, max_seq_length]
+        input_ids = tf.reshape(tf.io.decode_raw(features["input_ids"], tf.int32), shape)
+        token_type_ids = tf.reshape(tf.io.decode_raw(features["token_type_ids"], tf.int32), shape)
+        packed_mask = tf.io.decode_raw(features["attention_mask"], tf.uint8)  # [bsz, seq_len / 8]
+        # Unpack the most significant bit first, matching np.packbits()
+        shifts = tf.constant([7, 6, 5, 4, 3, 2, 1, 0], dtype=tf.uint8)
+        mask_bits = tf.bitwise.bitwise_and(
+            tf.bitwise.right_shift(tf.expand_dims(packed_mask, axis=-1), shifts), 1
+        )  # [bsz, seq_len / 8, 8]
+        attention_mask = tf.reshape(mask_bits, [per_gpu_batch_size, -1])[:, :max_seq_length]
+        return {
+            "input_ids": input_ids,
+            "token_type_ids": token_type_ids,
+            "attention_mask": tf.cast(attention_mask, tf.int32),
+        }
 
     if model_type in ["albert", "bert"]:
         assert max_predictions_per_seq is not None, "Pass --max_predictions_per_seq"
@@ -45,16 +67,11 @@ def get_dataset_from_tfrecords(
             "next_sentence_labels": tf.io.FixedLenFeature([1], tf.int64),
         }
     elif model_type in ["electra"]:
+        # Serialized as bytes by common/preprocess.py to halve the size of int64 features
         name_to_features = {
-            "input_ids": tf.io.FixedLenFeature(
-                [max_seq_length], tf.int64
-            ),  # corresponds to input_ids
-            "token_type_ids": tf.io.FixedLenFeature(
-                [max_seq_length], tf.int64
-            ),  # corresponds to token_type_ids
-            "attention_mask": tf.io.FixedLenFeature(
-                [max_seq_length], tf.int64
-            ),  # corresponds to attention_mask
+            "input_ids": tf.io.FixedLenFeature([], tf.string),  # int32 bytes
+            "token_type_ids": tf.io.FixedLenFeature([], tf.string),  # int32 bytes
+            "attention_mask": tf.io.FixedLenFeature([], tf.string),  # bit-packed bytes
         }
     else:
         raise ValueError(f"model_type={model_type} must be one of ['albert', 'bert', 'electra']")
@@ -81,11 +98,22 @@ def get_dataset_from_tfrecords(
         block_length=1,
         num_parallel_calls=cycle_length,
     )
-    # Map and batch will be automatically fused together, see https://www.tensorflow.org/api_docs/python/tf/data/experimental/map_and_batch
-    dataset = dataset.map(_parse_function, num_parallel_calls=num_cpu_threads)
     dataset = dataset.shuffle(buffer_size=buffer_size, reshuffle_each_iteration=True)
     dataset = dataset.batch(per_gpu_batch_size, drop_remainder=True)
-    # Shuffle the batches and prefetch some batches
+    # Shuffle the batches while they are still serialized, so the buffer holds compact strings
+    # and parsing happens on demand as the last stage rather than to fill the buffer
     dataset = dataset.shuffle(buffer_size=buffer_size, reshuffle_each_iteration=True)
+    # Batch before parsing, so that each parse call handles a whole batch of serialized examples
+    dataset = dataset.map(_parse_function, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+    options = tf.data.Options()
+    # The examples are shuffled anyway, so let parallel stages yield whichever element is ready first
+    options.experimental_deterministic = False
+    if shard:
+        # Every Horovod rank on the node runs its own pipeline, so split the cores between them
+        options.experimental_threading.private_threadpool_size = max(
+            1, os.cpu_count() // hvd.local_size()
+        )
+    dataset = dataset.with_options(options)
 
     return dataset
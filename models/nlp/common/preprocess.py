@@ -1,7 +1,7 @@
 """
 Example usage:
 ```bash
-python -m common.preprocess --dataset=wikitext-2 --shards=1 --processes=1 --cache_dir=/fsx/data_arrow/wikitext-2 --tfrecords_dir=/fsx/data_tfrecords/wikitext-2_512seq
+python -m common.preprocess --dataset=wikitext-2 --shards=1 --processes=1 --cache_dir=/fsx/data_arrow/wikitext-2 --tfrecords_dir=/fsx/data_tfrecords/wikitext-2_512seq --verify
 python -m common.preprocess --dataset=wikibooks --shards=2048 --processes=64 --cache_dir=/fsx/data_arrow/wikibooks --tfrecords_dir=/fsx/data_tfrecords/wikibooks_512seq
 ```
 
@@ -13,13 +13,12 @@ Inspiration from https://github.com/google-research/electra/blob/master/build_pr
 
 The steps are:
 1) Download data
-2) Filter empty lines (112k it/s)
-3) Replace newlines with space (121k it/s)
-4) Split on periods into sentences (66k it/s)
-5) Pre-tokenize sentences (12k it/s, 3hrs on Wikipedia) -- can be serialized
-6) Create examples (24k it/s, 3hrs on Wikipedia) -- can be serialized
-7) Convert example tokens into ids (0.15k it/s) -> because of casting ndarray to list? -- can be serialized
-8) Export to TFRecords
+2) For each shard, in parallel:
+    a) In a single map, so the intermediate columns are never cached:
+        i) Replace newlines with space and split on periods into sentences (empty lines yield none)
+        ii) Tokenize sentences into ids
+        iii) Create padded examples of ids
+    b) Export to that shard's TFRecord
 
 
 To directly inspect a TFRecord without knowing the spec:
@@ -27,30 +26,34 @@ tfds = tf.data.TFRecordDataset(filenames=[filename])
 for batch in tfds.take(1):
     example_proto = tf.train.Example.FromString(batch.numpy())
 
-To attempt loading in a VarLenFeature to see if you didn't serialize everything the same length:
-features = {
-    "input_ids": tf.io.VarLenFeature(tf.int64),
-    "token_type_ids": tf.io.VarLenFeature(tf.int64),
-    "attention_mask": tf.io.VarLenFeature(tf.int64),
-}
+Each feature is a single bytes value: input_ids and token_type_ids are raw int32, attention_mask
+is packed 8 bits to a byte. To decode one without knowing the sequence length:
+np.frombuffer(example_proto.features.feature["input_ids"].bytes_list.value[0], dtype=np.int32)
 """
 
 import argparse
+import hashlib
+import itertools
 import multiprocessing
 import os
-import random
+import re
 import sys
 import time
 from functools import partial
 from typing import List
 
 import nlp
-import tensorflow as tf
+import numpy as np
 from transformers import BertTokenizerFast
 
-from common.datasets import get_dataset_from_tfrecords
+try:
+    from numba import njit
+except ImportError:
+    # Numba only makes create_examples() faster, so fall back to plain Python without it
+    def njit(**kwargs):
+        return lambda func: func
+
 
-os.environ["TOKENIZERS_PARALLELISM"] = "false"
 os.environ["CUDA_VISIBLE_DEVICES"] = ""
 
 parser = argparse.ArgumentParser()
@@ -65,14 +68,22 @@ parser.add_argument("--processes", type=int, default=1)  # 64 processes is a swe
 parser.add_argument("--tfrecords_dir", default="/tmp/data_tfrecords")
 parser.add_argument("--skip_load_from_cache_file", action="store_true")
 parser.add_argument("--skip_tfrecords", action="store_true")
+parser.add_argument("--verify", action="store_true", help="Read back a batch of the TFRecords")
 args = parser.parse_args()
 
-FILTER_CACHE = "filterlines.arrow"
-NEWLINES_CACHE = "replacenewlines.arrow"
-SENTENCES_CACHE = "sentences.arrow"
-PRETOKENIZED_SENTENCES_CACHE = "pretokenized_sentences.arrow"
-EXAMPLES_CACHE = f"examples_{args.max_seq_length}seq.arrow"
-EXAMPLE_IDS_CACHE = f"example_ids_{args.max_seq_length}seq.arrow"
+# Each shard is processed by one process, so more processes than shards would sit idle.
+num_workers = min(args.processes, args.shards)
+# Use one level of parallelism: the Rust tokenizer's threads with a single process,
+# or many processes each tokenizing on one thread, to avoid oversubscribing the cores.
+os.environ["TOKENIZERS_PARALLELISM"] = "true" if num_workers == 1 else "false"
+
+
+def cache_file(stage: str, *keys) -> str:
+    """Names each stage's Arrow cache explicitly instead of relying on nlp's fingerprint, which
+    changes whenever the hash of a partial() or lambda does and silently reruns the stage.
+    Every key that changes the stage's output must be part of the name."""
+    return os.path.join(args.cache_dir, "_".join([args.dataset, stage, *map(str, keys)]) + ".arrow")
+
 
 load_from_cache_file = not args.skip_load_from_cache_file
 
@@ -122,24 +133,14 @@ else:
 print("Loaded dataset:", dset, dset[0])
 assert dset.column_names == ["text"], "Dataset should have exactly one 'text' column"
 
-print("Filtering empty lines")
-dset = dset.filter(
-    lambda ex: len(ex["text"]) > 0,
-    cache_file_name=os.path.join(args.cache_dir, FILTER_CACHE),
-    load_from_cache_file=load_from_cache_file,
-)
-print("Filtered empty lines:", dset, dset[0])
-print("Replacing newlines with space")
-dset = dset.map(
-    lambda batch: {"text": [text.strip().replace("\n", " ") for text in batch["text"]]},
-    batched=True,
-    cache_file_name=os.path.join(args.cache_dir, NEWLINES_CACHE),
-    load_from_cache_file=load_from_cache_file,
-)
-print("Replaced newlines with space:", dset, dset[0])
+
+# A sentence is a run of non-period characters ending in a period
+SENTENCE_REGEX = re.compile(r"[^.]+\.")
+# Replace newlines (and other line-breaking whitespace) with a space
+WHITESPACE_TABLE = str.maketrans("\n\r\t", "   ")
 
 
-def split_into_sentences(batch):
+def split_into_sentences(texts: List[str]) -> List[str]:
     """ Split into sentences using the '.' separator. Not perfect, converts
 
     Senjō no Valkyria 3 : Unrecorded Chronicles (
@@ -150,167 +151,193 @@ def split_into_sentences(batch):
     Media.Vision for the PlayStation Portable .
 
     into three sentences when it really is one. But works pretty well.
+
+    Newlines are replaced with spaces here too, rather than in a separate pass over the text.
+    Empty lines contain no sentences, so they drop out here without a separate filter pass.
     """
     sentences = []
-    for ex in batch["text"]:
-        batch_sentences = [sentence + "." for sentence in ex.split(".")]
-        batch_sentences = batch_sentences[:-1]
-        sentences.extend(batch_sentences)
-    return {"sentences": sentences}
-
-
-print("Splitting into sentences")
-dset = dset.map(
-    split_into_sentences,
-    batched=True,
-    remove_columns=["text"],
-    cache_file_name=os.path.join(args.cache_dir, SENTENCES_CACHE),
-    load_from_cache_file=load_from_cache_file,
-)
-print("Split into sentences:", dset, dset[0])
+    for ex in texts:
+        sentences.extend(SENTENCE_REGEX.findall(ex.translate(WHITESPACE_TABLE)))
+    return sentences
+
 
 tokenizer = BertTokenizerFast.from_pretrained("bert-base-uncased")
+# A different vocab or normalizer produces different ids, so it must not hit the same cache
+TOKENIZER_CHECKSUM = hashlib.md5(tokenizer._tokenizer.to_str().encode()).hexdigest()[:8]
 
 
-def pretokenize(batch):
-    """ Tokenize via list comprehension in Rust. """
+def tokenize(sentences: List[str]) -> List[List[int]]:
+    """ Tokenize via list comprehension in Rust. Keep the ids so we never have to re-encode. """
     encodings: List["Encoding"] = tokenizer._tokenizer.encode_batch(
-        batch["sentences"], add_special_tokens=False
+        sentences, add_special_tokens=False
     )
-    tokens: List[str] = [encoding.tokens for encoding in encodings]
-    return {"tokens": tokens}
+    return [encoding.ids for encoding in encodings]
 
 
-# dset = dset.select(np.arange(0, 60000))
-print("Pre-tokenizing sentences:")
-dset = dset.map(
-    pretokenize,
-    batched=True,
-    remove_columns=["sentences"],
-    cache_file_name=os.path.join(args.cache_dir, PRETOKENIZED_SENTENCES_CACHE),
-    load_from_cache_file=load_from_cache_file,
-)
-print("Pre-tokenized sentences:", dset, dset[0])
+@njit(cache=True)
+def pack_examples(
+    ids, offsets, max_length, cls_id, sep_id, single_segment, coin_flips, target_lengths
+):
+    """Packs sentences into [CLS] first_segment [SEP] second_segment [SEP] examples.
 
+    Sentence i is ids[offsets[i]:offsets[i + 1]]. Returns the flat packed ids, the offsets of each
+    example into them, and the length of each first segment (for token_type_ids).
 
-def create_examples(batch, max_length):
-    """Creates a pre-training example from the current list of sentences."""
-    target_length = max_length
+    The random draws are made up front in NumPy: coin_flips[i] decides whether an overflowing
+    sentence i still goes to the first segment, and target_lengths[j] is the length of example j.
+    """
+    num_sentences = len(offsets) - 1
+    first_segment = np.empty(len(ids), dtype=ids.dtype)
+    second_segment = np.empty(len(ids), dtype=ids.dtype)
+    # Every example adds three special tokens, and there is at most one example per sentence + 1
+    packed = np.empty(len(ids) + 3 * (num_sentences + 1), dtype=ids.dtype)
+    example_offsets = np.zeros(num_sentences + 2, dtype=np.int64)
+    first_lengths = np.zeros(num_sentences + 1, dtype=np.int64)
+    num_examples = 0
+
+    target_length = target_lengths[0]
     # small chance to only have one segment as in classification tasks
-    if random.random() < 0.1:
+    if single_segment:
         first_segment_target_length = 100000
     else:
         # -3 due to not yet having [CLS]/[SEP] tokens in the input text
         first_segment_target_length = (target_length - 3) // 2
 
-    first_segment, second_segment = [], []
-    examples = []
-    for sentence in batch["tokens"]:
-        # the sentence goes to the first segment if (1) the first segment is
-        # empty, (2) the sentence doesn't put the first segment over length or
-        # (3) 50% of the time when it does put the first segment over length
-        if (
-            len(first_segment) == 0
-            or len(first_segment) + len(sentence) < first_segment_target_length
-            or (
-                len(second_segment) == 0
-                and len(first_segment) < first_segment_target_length
-                and random.random() < 0.5
-            )
-        ):
-            first_segment += list(sentence)
-        else:
-            second_segment += list(sentence)
-            if len(first_segment) + len(second_segment) >= target_length:
-                # trim to max_length while accounting for not-yet-added [CLS]/[SEP] tokens
-                first_segment = first_segment[: max_length - 2]
-                second_segment = second_segment[: max(0, max_length - len(first_segment) - 3)]
-                example = ["[CLS]"] + first_segment + ["[SEP]"] + second_segment + ["[SEP]"]
-                examples.append(example)
-                first_segment, second_segment = [], []
-
-                if random.random() < 0.05:
-                    target_length = random.randint(5, max_length)
-                else:
-                    target_length = max_length
-
-    # This last one may be a little short, but it's necessary to always return something from the function
-    # for the function inspection that only passes two sentences.
-    examples.append(["[CLS]"] + first_segment + ["[SEP]"] + second_segment + ["[SEP]"])
-
-    return {"examples": examples}
+    first_length, second_length = 0, 0
+    for i in range(num_sentences + 1):
+        if i < num_sentences:
+            sentence = ids[offsets[i] : offsets[i + 1]]
+            # the sentence goes to the first segment if (1) the first segment is
+            # empty, (2) the sentence doesn't put the first segment over length or
+            # (3) 50% of the time when it does put the first segment over length
+            if (
+                first_length == 0
+                or first_length + len(sentence) < first_segment_target_length
+                or (
+                    second_length == 0
+                    and first_length < first_segment_target_length
+                    and coin_flips[i]
+                )
+            ):
+                first_segment[first_length : first_length + len(sentence)] = sentence
+                first_length += len(sentence)
+                continue
+            second_segment[second_length : second_length + len(sentence)] = sentence
+            second_length += len(sentence)
+            if first_length + second_length < target_length:
+                continue
+            # trim to max_length while accounting for not-yet-added [CLS]/[SEP] tokens
+            first_length = min(first_length, max_length - 2)
+            second_length = min(second_length, max(0, max_length - first_length - 3))
+        # Else this is the last one. It may be a little short, but it's necessary to always
+        # return something from the function for the function inspection that only passes two sentences.
+
+        start = example_offsets[num_examples]
+        packed[start] = cls_id
+        start += 1
+        packed[start : start + first_length] = first_segment[:first_length]
+        start += first_length
+        packed[start] = sep_id
+        start += 1
+        packed[start : start + second_length] = second_segment[:second_length]
+        start += second_length
+        packed[start] = sep_id
+        start += 1
+        first_lengths[num_examples] = first_length
+        num_examples += 1
+        example_offsets[num_examples] = start
+        first_length, second_length = 0, 0
+        target_length = target_lengths[num_examples]
+
+    return (
+        packed[: example_offsets[num_examples]],
+        example_offsets[: num_examples + 1],
+        first_lengths[:num_examples],
+    )
 
 
-print("Creating examples")
-dset = dset.map(
-    partial(create_examples, max_length=args.max_seq_length),
-    batched=True,
-    remove_columns=["tokens"],
-    cache_file_name=os.path.join(args.cache_dir, EXAMPLES_CACHE),
-    load_from_cache_file=load_from_cache_file,
-)
-print("Created examples:", dset, dset[0])
-# WARNING: Some of these examples are shorter than 512 sequence length.
-# View with [len(ex["examples"]) for ex in dset]
-
-# This method is very slow (0.15 it/s, so 0.15k examples/sec
-# Improvement tracked in https://github.com/huggingface/transformers/issues/5729
-print(f"Padding, truncating, and encoding examples into ids. num_processes={args.processes}")
-
-
-def tokenizer_batch(batch, tokenizer):
-    # This must be defined in __main__ for serialization
-    return tokenizer(
-        batch["examples"],
-        add_special_tokens=False,
-        is_pretokenized=True,
-        padding="max_length",
-        truncation=True,
-        max_length=args.max_seq_length,
+@njit(cache=True)
+def pad_examples(packed, example_offsets, first_lengths, max_length, pad_id):
+    """ Truncates and pads the packed examples into input_ids, token_type_ids, attention_mask. """
+    num_examples = len(first_lengths)
+    input_ids = np.full((num_examples, max_length), pad_id, dtype=np.int32)
+    token_type_ids = np.zeros((num_examples, max_length), dtype=np.int32)
+    attention_mask = np.zeros((num_examples, max_length), dtype=np.int8)
+    for i in range(num_examples):
+        length = min(example_offsets[i + 1] - example_offsets[i], max_length)
+        input_ids[i, :length] = packed[example_offsets[i] : example_offsets[i] + length]
+        token_type_ids[i, first_lengths[i] + 2 : length] = 1
+        attention_mask[i, :length] = 1
+    return input_ids, token_type_ids, attention_mask
+
+
+def create_examples(sentence_ids: List[List[int]], max_length, cls_id, sep_id, pad_id):
+    """Creates pre-training examples of ids from the current list of sentences."""
+    if len(sentence_ids) == 0:
+        # A batch of only empty lines, which would otherwise still pack one [CLS] [SEP] [SEP]
+        return {"input_ids": [], "token_type_ids": [], "attention_mask": []}
+    # Flatten the sentences so the packing loop can run natively in Numba
+    lengths = np.array([len(sentence) for sentence in sentence_ids], dtype=np.int64)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    ids = np.fromiter(
+        itertools.chain.from_iterable(sentence_ids), dtype=np.int64, count=offsets[-1]
     )
 
-
-def shard_and_map(index, filename, num_shards, function, **kwargs):
-    print(f"Sharding on process {index}")
-    shard = nlp.Dataset.from_file(filename).shard(
-        num_shards, index, contiguous=True, load_from_cache_file=load_from_cache_file
+    # Draw all the randomness for this batch at once; there is at most one example per sentence + 1
+    num_sentences = len(sentence_ids)
+    coin_flips = np.random.random(num_sentences) < 0.5
+    target_lengths = np.where(
+        np.random.random(num_sentences + 1) < 0.05,
+        np.random.randint(5, max_length + 1, size=num_sentences + 1),
+        max_length,
+    )
+    target_lengths[0] = max_length
+
+    packed, example_offsets, first_lengths = pack_examples(
+        ids,
+        offsets,
+        max_length=max_length,
+        cls_id=cls_id,
+        sep_id=sep_id,
+        single_segment=np.random.random() < 0.1,
+        coin_flips=coin_flips,
+        target_lengths=target_lengths,
+    )
+    input_ids, token_type_ids, attention_mask = pad_examples(
+        packed, example_offsets, first_lengths, max_length=max_length, pad_id=pad_id
     )
-    print(f"Done sharding on process {index}. Mapping the shard")
-    tokenizer = BertTokenizerFast.from_pretrained("bert-base-uncased")
-    return shard.map(partial(function, tokenizer=tokenizer), **kwargs)
+    return {
+        "input_ids": input_ids,
+        "token_type_ids": token_type_ids,
+        "attention_mask": attention_mask,
+    }
 
 
-def multiprocess_map(dset, num_processes, function, **kwargs):
-    with multiprocessing.Pool(processes=num_processes) as pool:
-        shards = pool.map(
-            partial(
-                shard_and_map,
-                filename=dset._data_files[0]["filename"],
-                num_shards=num_processes,
-                function=function,
-                **kwargs,
-            ),
-            range(num_processes),
-        )
-    return nlp.concatenate_datasets(shards)
+def preprocess(batch, max_length, cls_id, sep_id, pad_id):
+    """Runs every stage on a batch of documents in memory, so only the final examples are cached.
 
+    Writing the sentences, tokens, and unpadded examples to their own Arrow caches meant several
+    full-dataset write/read round trips for columns that the next stage immediately consumed.
+    """
+    sentences = split_into_sentences(batch["text"])
+    sentence_ids = tokenize(sentences)
+    return create_examples(
+        sentence_ids, max_length=max_length, cls_id=cls_id, sep_id=sep_id, pad_id=pad_id
+    )
 
-dset = multiprocess_map(
-    dset=dset,
-    num_processes=args.processes,
-    function=tokenizer_batch,
-    batched=True,
-    remove_columns=["examples"],
-    cache_file_name=os.path.join(args.cache_dir, EXAMPLE_IDS_CACHE),
-    load_from_cache_file=load_from_cache_file,
-)
-print("Padded, truncated, and encoded examples into ids:", dset, dset[0])
-# dset = nlp.Dataset.from_file(cache_file)
 
-if args.skip_tfrecords:
-    sys.exit()
+# Declaring the schema stores the columns as int32/int8 rather than inferring int64. Since
+# create_examples() returns ndarrays of those dtypes, Arrow converts each row without a cast.
+EXAMPLE_FEATURES = nlp.Features(
+    {
+        "input_ids": nlp.Sequence(nlp.Value("int32")),
+        "token_type_ids": nlp.Sequence(nlp.Value("int32")),
+        "attention_mask": nlp.Sequence(nlp.Value("int8")),
+    }
+)
 
-### Export to sharded TFRecords ###
+### Create examples and export them to sharded TFRecords ###
 
 tfrecord_files = [
     os.path.join(args.tfrecords_dir, f"{args.dataset}_shard_{i}.tfrecord")
@@ -318,37 +345,118 @@ tfrecord_files = [
 ]
 
 
-def shard_and_export(index):
-    dset_shard = dset.shard(num_shards=args.shards, index=index, contiguous=False)
-    dset_shard.set_format("numpy")
-    dset_shard.export(tfrecord_files[index])
+def write_tfrecord(dset_shard, filename, batch_size=1000):
+    """Writes one tf.train.Example per row.
+
+    nlp's Dataset.export() reads and converts one row at a time, so we read batches of columns.
+    Each feature is stored as a single bytes value rather than an Int64List: input_ids and
+    token_type_ids as raw int32, and attention_mask packed 8 bits to a byte.
+    See get_dataset_from_tfrecords() for the matching parser.
+    """
+    # Imported here so runs that stop before exporting never pay for loading TensorFlow
+    import tensorflow as tf
+
+    columns = ["input_ids", "token_type_ids", "attention_mask"]
+    dset_shard.set_format("numpy", columns=columns)
+    with tf.io.TFRecordWriter(filename) as writer:
+        for start in range(0, len(dset_shard), batch_size):
+            batch = dset_shard[start : start + batch_size]
+            input_ids = batch["input_ids"].astype(np.int32)
+            token_type_ids = batch["token_type_ids"].astype(np.int32)
+            attention_mask = np.packbits(batch["attention_mask"].astype(np.uint8), axis=1)
+            for row in zip(input_ids, token_type_ids, attention_mask):
+                feature = {
+                    column: tf.train.Feature(
+                        bytes_list=tf.train.BytesList(value=[values.tobytes()])
+                    )
+                    for column, values in zip(columns, row)
+                }
+                example = tf.train.Example(features=tf.train.Features(feature=feature))
+                writer.write(example.SerializeToString())
+
+
+def process_shard(index):
+    """Creates the examples for one shard and immediately exports them to its TFRecord.
+
+    Sharding before the map means each worker streams its own slice from text to TFRecord,
+    instead of the whole dataset being mapped before the first shard can be written.
+    """
+    examples_cache = cache_file(
+        "examples", f"{args.max_seq_length}seq", TOKENIZER_CHECKSUM, f"shard{index}of{args.shards}"
+    )
+    if args.shards > 1 and load_from_cache_file and os.path.exists(examples_cache):
+        # nlp's map() only looks for an existing cache on file-backed datasets, and the shard copy
+        # below is kept in memory, so check here. This also skips copying the text on reruns.
+        dset_shard = nlp.Dataset.from_file(examples_cache)
+    else:
+        if args.shards == 1:
+            # The whole dataset is file-backed, so map it directly and let nlp find the cache
+            dset_shard = dset
+        else:
+            # nlp's shard() copies the selected rows into a new Arrow table. Keep that copy of the
+            # text in memory rather than writing it to cache_dir; it is a 1/shards slice.
+            dset_shard = dset.shard(
+                num_shards=args.shards, index=index, contiguous=True, keep_in_memory=True
+            )
+        dset_shard = dset_shard.map(
+            partial(
+                preprocess,
+                max_length=args.max_seq_length,
+                cls_id=tokenizer.cls_token_id,
+                sep_id=tokenizer.sep_token_id,
+                pad_id=tokenizer.pad_token_id,
+            ),
+            batched=True,
+            # Large batches amortize each call into the Rust tokenizer's thread pool
+            batch_size=50_000 if num_workers == 1 else 10_000,
+            remove_columns=["text"],
+            features=EXAMPLE_FEATURES,
+            cache_file_name=examples_cache,
+            writer_batch_size=10_000,
+            load_from_cache_file=load_from_cache_file,
+        )
+    if not args.skip_tfrecords:
+        write_tfrecord(dset_shard, tfrecord_files[index])
+    return len(dset_shard)
+
+
+# Compile the Numba kernels once here, so forked workers inherit them instead of each compiling
+create_examples(
+    [[1, 2, 3], [4, 5]],
+    max_length=8,
+    cls_id=tokenizer.cls_token_id,
+    sep_id=tokenizer.sep_token_id,
+    pad_id=tokenizer.pad_token_id,
+)
 
+# dset = dset.select(np.arange(0, 60000))
+print("Creating examples")
+if num_workers == 1:
+    num_examples = [process_shard(index) for index in range(args.shards)]
+else:
+    # Beware of TensorFlow + multiprocessing. Ensure there are no visible GPUs so everything
+    # happens on CPU.
+    with multiprocessing.Pool(processes=num_workers) as pool:
+        num_examples = pool.map(process_shard, range(args.shards), chunksize=1)
+print(f"Created {sum(num_examples)} examples in {args.shards} shards")
 
-# Beware of TensorFlow + multiprocessing. Ensure there are no visible GPUs so everything happens on CPU.
-with multiprocessing.Pool(processes=args.processes) as pool:
-    pool.map(shard_and_export, range(args.shards))
+if args.skip_tfrecords:
+    sys.exit()
 
 ### Now read in a TFRecord to ensure exporting happened correctly ###
 
-name_to_features = {
-    "input_ids": tf.io.FixedLenFeature([args.max_seq_length], tf.int64),  # corresponds to input_ids
-    "token_type_ids": tf.io.FixedLenFeature(
-        [args.max_seq_length], tf.int64
-    ),  # corresponds to token_type_ids
-    "attention_mask": tf.io.FixedLenFeature(
-        [args.max_seq_length], tf.int64,
-    ),  # corresponds to attention_mask
-}
-
-tfds = get_dataset_from_tfrecords(
-    model_type="electra",
-    filenames=tfrecord_files,
-    max_seq_length=args.max_seq_length,
-    per_gpu_batch_size=4,
-    shard=False,
-)
-for batch in tfds.take(1):
-    print(batch)
+if args.verify:
+    from common.datasets import get_dataset_from_tfrecords
+
+    tfds = get_dataset_from_tfrecords(
+        model_type="electra",
+        filenames=tfrecord_files,
+        max_seq_length=args.max_seq_length,
+        per_gpu_batch_size=4,
+        shard=False,
+    )
+    for batch in tfds.take(1):
+        print(batch)
 
 elapsed = time.perf_counter() - start_time
 print(f"Total processing time: {elapsed:.3f} seconds")
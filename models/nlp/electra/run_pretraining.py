@@ -4,13 +4,11 @@ Batch sizes: 32 = 5GB memory, 128 = 17GB
 The "read -1 expected ..." errors are harmless and come from Docker. See https://github.com/horovod/horovod/issues/503
 Running Docker in privileged mode (docker run --privileged) solves the issue.
 
-Dataset handling: Lots of empty lines, use dataset.filter() to eliminate those.
-For now, just grab one sentence.
-TODO: Combine two segments into a single example. https://github.com/google-research/electra/blob/master/build_pretraining_dataset.py
-TODO: Add zero-padding for shorter sequences
-
-nlp feature request: Select from dataset with arbitrary slices
-`nlp` package tutorial: https://colab.research.google.com/github/huggingface/nlp/blob/master/notebooks/Overview.ipynb
+Dataset handling: Examples are created offline by common/preprocess.py. Empty lines produce no
+sentences and drop out during packing, two segments are packed into each example, and examples are
+padded to max_seq_length and written as int32 TFRecords.
+Training reads those with get_dataset_from_tfrecords(), so there is no Python generator in the
+input pipeline.
 """
 
 import datetime
@@ -19,8 +17,9 @@ import logging
 import os
 import time
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import asdict
-from typing import Tuple
+from typing import List, Tuple
 
 import numpy as np
 import tensorflow as tf
@@ -28,6 +27,7 @@ from transformers import (
     ElectraConfig,
     ElectraTokenizer,
     ElectraTokenizerFast,
+    GradientAccumulator,
     HfArgumentParser,
     TFElectraForMaskedLM,
     TFElectraForPreTraining,
@@ -67,31 +67,34 @@ def log_example(tokenizer, ids, masked_ids, mask, gen_ids, dis_preds):
 # TODO: Re-add validation step
 
 
-def generate_corruption_mask(ids, attention_mask):
-    mask = (
-        tf.cast(tf.random.uniform(shape=ids.shape) > 0.85, dtype=attention_mask.dtype)
-        * attention_mask
-    )
-    return mask
+def generate_corruption_mask(ids, attention_mask, seed=None):
+    """Returns a bool mask, since a binary mask doesn't need the bandwidth of an int64 one.
+
+    With a seed, the draw is stateless, so there is no RNG state op for XLA to cluster around.
+    """
+    if seed is None:
+        uniform = tf.random.uniform(shape=ids.shape)
+    else:
+        uniform = tf.random.stateless_uniform(shape=ids.shape, seed=seed)
+    return tf.logical_and(uniform > 0.85, tf.cast(attention_mask, dtype=tf.bool))
 
 
 def mask_ids(ids, corruption_mask, mask_id):
-    return tf.where(tf.cast(corruption_mask, tf.bool), tf.cast(mask_id, dtype=ids.dtype), ids)
+    return tf.where(corruption_mask, tf.cast(mask_id, dtype=ids.dtype), ids)
 
 
 # TODO: Make temperature a hyperparameter
-def temperature_sampling(logits, output_type, per_gpu_batch_size, max_seq_length, temperature):
+def temperature_sampling(logits, output_type, temperature):
     if temperature is None or temperature == 0.0:
         return tf.argmax(logits, axis=-1, output_type=output_type)
 
     logger.info(f"temperature {temperature}")
 
     log_prob = tf.nn.log_softmax(logits / temperature)
-    log_prob = tf.reshape(
-        log_prob, [per_gpu_batch_size * max_seq_length, -1], name=None
-    )  # [bsz, seq_len]
-    preds = tf.cast(tf.random.categorical(log_prob, 1), tf.int64)
-    preds = tf.reshape(preds, [per_gpu_batch_size, max_seq_length], name=None)  # [bsz, seq_len]
+    # Take the shapes from the logits, so callers can't pass sizes that disagree with the batch
+    log_prob = tf.reshape(log_prob, [-1, logits.shape[-1]])  # [bsz * seq_len, vocab_size]
+    preds = tf.random.categorical(log_prob, 1, dtype=output_type)
+    preds = tf.reshape(preds, tf.shape(logits)[:-1])  # [bsz, seq_len]
     return preds
 
 
@@ -102,58 +105,48 @@ def forward(
     masked_ids,
     attention_mask,
     corruption_mask,
-    per_gpu_batch_size,
-    max_seq_length,
     return_preds=False,
 ):
-    ids = tf.cast(ids, tf.int64)
-    corruption_mask = tf.cast(corruption_mask, tf.int64)
-
     # Generator loss
     (gen_logits,) = gen(
         {"input_ids": masked_ids, "attention_mask": attention_mask}
     )  # [bsz, seq_len, vocab_size]
-    gen_loss = tf.keras.losses.sparse_categorical_crossentropy(
-        y_true=tf.boolean_mask(ids, corruption_mask),  # [bsz * n_masks, vocab_size]
-        y_pred=tf.boolean_mask(gen_logits, corruption_mask),  # [bsz * n_masks]
-        from_logits=True,
-    )  # [bsz * n_masks]
-    gen_loss = tf.reduce_mean(gen_loss)  # [1]
+    gen_loss = tf.nn.sparse_softmax_cross_entropy_with_logits(
+        labels=ids, logits=gen_logits
+    )  # [bsz, seq_len]
+    # Average over the corrupted tokens with a weighted sum, since boolean_mask has a dynamic shape
+    gen_weights = tf.cast(corruption_mask, dtype=gen_loss.dtype)  # [bsz, seq_len]
+    gen_loss = tf.reduce_sum(gen_loss * gen_weights) / (tf.reduce_sum(gen_weights) + 1e-5)  # [1]
 
     # Generator accuracy
-    # argmax returns tf.int64 by default
+    # Sample in the int32 dtype of the ids, rather than the int64 that argmax returns by default
     # adv_ids = tf.argmax(gen_logits, axis=-1, output_type=ids.dtype)  # [bsz, seq_len]
     adv_ids = temperature_sampling(
         logits=gen_logits,
         output_type=ids.dtype,
-        per_gpu_batch_size=per_gpu_batch_size,
-        max_seq_length=max_seq_length,
         temperature=1.0,
     )
-    ids_equal = tf.cast(adv_ids == ids, dtype=tf.int64)  # [bsz, seq_len]
-    gen_correct = tf.boolean_mask(ids_equal, corruption_mask)  # [bsz * n_masks]
-    gen_acc = tf.reduce_mean(tf.cast(gen_correct, dtype=tf.float32))  # [1]
+    # Average over the corrupted tokens, reusing the loss weights
+    ids_equal = tf.cast(adv_ids == ids, dtype=gen_weights.dtype)  # [bsz, seq_len]
+    gen_acc = tf.reduce_sum(ids_equal * gen_weights) / (tf.reduce_sum(gen_weights) + 1e-5)  # [1]
 
     # Discriminator loss
-    gen_ids = corruption_mask * adv_ids + (1 - corruption_mask) * ids  # [bsz, seq_len]
+    gen_ids = tf.where(corruption_mask, adv_ids, ids)  # [bsz, seq_len]
     (dis_logits,) = dis({"input_ids": gen_ids, "attention_mask": attention_mask})  # [bsz, seq_len]
     # If generator generates correct token, invert the loss
-    is_corrupted = tf.cast(gen_ids != ids, tf.int64)
-    dis_loss = tf.keras.losses.binary_crossentropy(
-        y_true=tf.boolean_mask(is_corrupted, attention_mask),
-        y_pred=tf.boolean_mask(dis_logits, attention_mask),
-        from_logits=True,
-    )
-
-    dis_loss = tf.reduce_mean(dis_loss)
+    is_corrupted = gen_ids != ids  # [bsz, seq_len] (bool)
+    dis_loss = tf.nn.sigmoid_cross_entropy_with_logits(
+        labels=tf.cast(is_corrupted, dtype=dis_logits.dtype), logits=dis_logits
+    )  # [bsz, seq_len]
+    # Average over the real (non-padding) tokens
+    dis_weights = tf.cast(attention_mask, dtype=dis_loss.dtype)  # [bsz, seq_len]
+    dis_loss = tf.reduce_sum(dis_loss * dis_weights) / (tf.reduce_sum(dis_weights) + 1e-5)  # [1]
 
     # Discriminator accuracy
     # TODO: Check that accuracy_mask is different
-    dis_probs = tf.math.sigmoid(dis_logits)  # [bsz, seq_len]
-    dis_preds = tf.cast(dis_probs > 0.5, dtype=corruption_mask.dtype)  # [bsz, seq_len] (bool)
-    dis_acc = tf.reduce_mean(
-        tf.cast(tf.cast(dis_preds, tf.bool) == (gen_ids != ids), dtype=tf.float32)
-    )  # gen_ids != ids is corrupted
+    # sigmoid(x) > 0.5 exactly when x > 0, so skip the sigmoid
+    dis_preds = dis_logits > 0.0  # [bsz, seq_len] (bool)
+    dis_acc = tf.reduce_mean(tf.cast(dis_preds == is_corrupted, dtype=tf.float32))  # [1]
 
     # Generator is 30,000-way classification loss, while discriminator is binary classification.
     lmbda = 50
@@ -166,7 +159,7 @@ def forward(
 
 
 @tf.function
-def val_step(gen, dis, ids, attention_mask, per_gpu_batch_size, max_seq_length, mask_token_id: int):
+def val_step(gen, dis, ids, attention_mask, mask_token_id: int):
     corruption_mask = generate_corruption_mask(ids=ids, attention_mask=attention_mask)
     masked_ids = mask_ids(ids=ids, corruption_mask=corruption_mask, mask_id=mask_token_id)
     loss, gen_loss, dis_loss, gen_acc, dis_acc, gen_ids, dis_preds = forward(
@@ -205,64 +198,135 @@ def val_step(gen, dis, ids, attention_mask, per_gpu_batch_size, max_seq_length,
     )
 
 
+def get_trainable_variables(gen, dis):
+    # Be careful not to double-apply gradients by having duplicate embeddings in the variable list
+    # See https://github.com/tensorflow/tensorflow/issues/30712
+    vars = gen.trainable_variables + dis.trainable_variables
+    # Tensor is unhashable, so can't do list(set(vars))
+    # Relies on all ranks doing the same list->dict->list ordering
+    # Ensure that this happens every time, not just during function tracing
+    # tf.print(f"vars has length {len(vars)} before dedupe")
+    vars = list({var.experimental_ref(): var for var in vars}.values())
+    # tf.print(f"vars has length {len(vars)} after dedupe")
+    return vars
+
+
+def train_batch(
+    optimizer, gen, dis, ids, attention_mask, mask_token_id: int, seed, accumulate: bool
+):
+    """ Returns the scaled gradients of one batch, allreduced unless they are being accumulated. """
+    corruption_mask = generate_corruption_mask(ids=ids, attention_mask=attention_mask, seed=seed)
+    masked_ids = mask_ids(ids=ids, corruption_mask=corruption_mask, mask_id=mask_token_id)
+    with tf.GradientTape() as tape:
+        loss, gen_loss, dis_loss, gen_acc, dis_acc = forward(
+            gen=gen,
+            dis=dis,
+            ids=ids,
+            masked_ids=masked_ids,
+            attention_mask=attention_mask,
+            corruption_mask=corruption_mask,
+        )
+        scaled_loss = optimizer.get_scaled_loss(loss)
+
+    if not accumulate:
+        # Horovod fuses the allreduces into large buffers and overlaps them with the backward pass
+        # This sparse_as_dense speedup is absolutely necessary here, even though it doesn't make a difference for ALBERT
+        tape = hvd.DistributedGradientTape(
+            tape, compression=hvd.Compression.fp16, sparse_as_dense=True
+        )
+    scaled_grads = tape.gradient(scaled_loss, get_trainable_variables(gen, dis))
+
+    Output = namedtuple("Output", ["loss", "gen_loss", "dis_loss", "gen_acc", "dis_acc"])
+    return (
+        scaled_grads,
+        Output(loss=loss, gen_loss=gen_loss, dis_loss=dis_loss, gen_acc=gen_acc, dis_acc=dis_acc),
+    )
+
+
 @tf.function
 def train_step(
-    optimizer, gen, dis, ids, attention_mask, per_gpu_batch_size, max_seq_length, mask_token_id: int
+    optimizer, gen, dis, ids, attention_mask, mask_token_id: int, gradient_accumulator=None
 ):
     """
     Attention mask refers to padding tokens.
         1 is a real token, 0 is a padding token.
     Corruption mask refers to which tokens are replaced by the generator.
-        1 is a corrupted (replaced) token, 0 is an original token.
+        True is a corrupted (replaced) token, False is an original token.
     tf.boolean_mask([[1,2], [3,4], [5,6]], [True, False, True]) -> [[1,2], [5,6]]
     Id-to-token reference:
         0: PAD
         103: MASK
+    With a gradient_accumulator, ids and attention_mask are [grad_steps, bsz, seq_len]. Each batch's
+    gradients are accumulated locally, and only their average is allreduced once at the end.
     """
-    corruption_mask = generate_corruption_mask(ids=ids, attention_mask=attention_mask)
-    masked_ids = mask_ids(ids=ids, corruption_mask=corruption_mask, mask_id=mask_token_id)
-    with tf.GradientTape() as tape:
-        loss, gen_loss, dis_loss, gen_acc, dis_acc = forward(
+    rank = tf.constant(hvd.rank(), tf.int64)
+    step = tf.cast(optimizer.iterations, tf.int64)
+    if gradient_accumulator is None:
+        # A different mask every step and on every rank
+        seed = tf.stack([step, rank])
+        scaled_grads, output = train_batch(
+            optimizer=optimizer,
             gen=gen,
             dis=dis,
             ids=ids,
-            masked_ids=masked_ids,
             attention_mask=attention_mask,
-            per_gpu_batch_size=per_gpu_batch_size,
-            max_seq_length=max_seq_length,
-            corruption_mask=corruption_mask,
+            mask_token_id=mask_token_id,
+            seed=seed,
+            accumulate=False,
         )
+    else:
+        gradient_accumulation_steps = ids.shape[0]
+        outputs = []
+        for micro_step in range(gradient_accumulation_steps):
+            seed = tf.stack([step * gradient_accumulation_steps + micro_step, rank])
+            batch_grads, batch_output = train_batch(
+                optimizer=optimizer,
+                gen=gen,
+                dis=dis,
+                ids=ids[micro_step],
+                attention_mask=attention_mask[micro_step],
+                mask_token_id=mask_token_id,
+                seed=seed,
+                accumulate=True,
+            )
+            gradient_accumulator(
+                [
+                    tf.convert_to_tensor(grad)
+                    if grad is not None and isinstance(grad, tf.IndexedSlices)
+                    else grad
+                    for grad in batch_grads
+                ]
+            )
+            outputs.append(batch_output)
+        # Average each metric over the accumulation steps
+        output = batch_output._make(
+            tf.add_n(list(values)) / gradient_accumulation_steps for values in zip(*outputs)
+        )
+        scaled_grads = [
+            hvd.allreduce(grad / gradient_accumulation_steps, compression=hvd.Compression.fp16)
+            if grad is not None
+            else None
+            for grad in gradient_accumulator.gradients
+        ]
 
-    # Be careful not to double-apply gradients by having duplicate embeddings in the variable list
-    # See https://github.com/tensorflow/tensorflow/issues/30712
-    vars = gen.trainable_variables + dis.trainable_variables
-    # Tensor is unhashable, so can't do list(set(vars))
-    # Relies on all ranks doing the same list->dict->list ordering
-    # Ensure that this happens every time, not just during function tracing
-    # tf.print(f"vars has length {len(vars)} before dedupe")
-    vars = list({var.experimental_ref(): var for var in vars}.values())
-    # tf.print(f"vars has length {len(vars)} after dedupe")
-    grads = tape.gradient(loss, vars)
-    # This sparse_as_dense speedup is absolutely necessary here, even though it doesn't make a difference for ALBERT
-    grads = [
-        tf.convert_to_tensor(grad)
-        if grad is not None and isinstance(grad, tf.IndexedSlices)
-        else grad
-        for grad in grads
-    ]
-    grads = [
-        hvd.allreduce(grad, compression=hvd.Compression.fp16) if grad is not None else None
-        for grad in grads
-    ]
-    optimizer.apply_gradients(zip(grads, vars))
-
-    Output = namedtuple("Output", ["loss", "gen_loss", "dis_loss", "gen_acc", "dis_acc"])
-    return Output(loss=loss, gen_loss=gen_loss, dis_loss=dis_loss, gen_acc=gen_acc, dis_acc=dis_acc)
+    grads = optimizer.get_unscaled_gradients(scaled_grads)
+    optimizer.apply_gradients(zip(grads, get_trainable_variables(gen, dis)))
+    if gradient_accumulator is not None:
+        gradient_accumulator.reset()
+    return output
 
 
 def get_checkpoint_paths_from_prefix(prefix: str) -> Tuple[str, str, str]:
     """ Returns the model_ckpt path and optimizer_ckpt path. """
-    return f"{prefix}-discriminator.ckpt", f"{prefix}-generator.ckpt", f"{prefix}-optimizer.npy"
+    return f"{prefix}-discriminator.ckpt", f"{prefix}-generator.ckpt", f"{prefix}-optimizer.npz"
+
+
+def load_optimizer_weights(optimizer_ckpt: str) -> List[np.ndarray]:
+    """ Loads weights saved by np.savez, or the pickled .npy list of older checkpoints. """
+    if not os.path.exists(optimizer_ckpt):
+        return list(np.load(f"{os.path.splitext(optimizer_ckpt)[0]}.npy", allow_pickle=True))
+    with np.load(optimizer_ckpt) as weights:
+        return [weights[f"arr_{i}"] for i in range(len(weights.files))]
 
 
 def main():
@@ -286,6 +350,8 @@ def main():
         tf.config.experimental.set_memory_growth(gpu, True)
     if gpus:
         tf.config.experimental.set_visible_devices(gpus[hvd.local_rank()], "GPU")
+    # XLA auto-clustering, since the Horovod ops in train_step can't be compiled as a whole
+    tf.config.optimizer.set_jit(train_args.skip_xla != "true")
     if train_args.eager == "true":
         tf.config.experimental_run_functions_eagerly(True)
 
@@ -299,6 +365,13 @@ def main():
     gen = TFElectraForMaskedLM(config=gen_config)
     dis = TFElectraForPreTraining(config=dis_config)
     optimizer = get_adamw_optimizer(train_args)
+    # Enable AMP loss scaling.
+    optimizer = tf.train.experimental.enable_mixed_precision_graph_rewrite(
+        optimizer, loss_scale="dynamic"
+    )
+    # Without accumulation, train_step allreduces straight from the tape instead
+    do_gradient_accumulation = train_args.gradient_accumulation_steps > 1
+    gradient_accumulator = GradientAccumulator() if do_gradient_accumulation else None
 
     # Tie the weights
     if model_args.electra_tie_weights == "true":
@@ -311,7 +384,7 @@ def main():
         if hvd.rank() == 0:
             dis.load_weights(dis_ckpt)
             gen.load_weights(gen_ckpt)
-            loaded_optimizer_weights = np.load(optimizer_ckpt, allow_pickle=True)
+            loaded_optimizer_weights = load_optimizer_weights(optimizer_ckpt)
 
     start_time = time.perf_counter()
 
@@ -324,6 +397,9 @@ def main():
             TqdmLoggingHandler(),
         ]
         summary_writer = None  # Only create a writer if we make it through a successful step
+        # Serializes optimizer checkpoints off the training thread, one at a time
+        checkpoint_executor = ThreadPoolExecutor(max_workers=1)
+        checkpoint_future = None
         logging.basicConfig(level=level, format=format, handlers=handlers)
         wandb_run_name = None
 
@@ -359,7 +435,12 @@ def main():
         max_seq_length=data_args.max_seq_length,
     )
 
-    tf_train_dataset = tf_train_dataset.prefetch(buffer_size=8)
+    if do_gradient_accumulation:
+        # Batch of batches, helpful for gradient accumulation. Shape [grad_steps, per_gpu_batch_size, ...]
+        tf_train_dataset = tf_train_dataset.batch(
+            train_args.gradient_accumulation_steps, drop_remainder=True
+        )
+    tf_train_dataset = tf_train_dataset.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
 
     if hvd.rank() == 0:
         tf_val_dataset = get_dataset_from_tfrecords(
@@ -368,13 +449,12 @@ def main():
             per_gpu_batch_size=train_args.per_gpu_batch_size,
             max_seq_length=data_args.max_seq_length,
         )
-        tf_val_dataset = tf_val_dataset.prefetch(buffer_size=8)
+        tf_val_dataset = tf_val_dataset.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
 
     wandb_run_name = None
 
     step = 1
     for batch in tf_train_dataset:
-        learning_rate = optimizer.learning_rate(step=tf.constant(step, dtype=tf.float32))
         ids = batch["input_ids"]
         attention_mask = batch["attention_mask"]
         train_result = train_step(
@@ -383,9 +463,8 @@ def main():
             dis=dis,
             ids=ids,
             attention_mask=attention_mask,
-            per_gpu_batch_size=train_args.per_gpu_batch_size,
-            max_seq_length=data_args.max_seq_length,
             mask_token_id=tokenizer.mask_token_id,
+            gradient_accumulator=gradient_accumulator,
         )
 
         if step == 1:
@@ -404,6 +483,8 @@ def main():
                 (step % log_args.checkpoint_frequency == 0) or is_final_step
             )
             do_validation = step % log_args.validation_frequency == 0
+            # Only needed for logging, so other ranks skip the eager op
+            learning_rate = optimizer.learning_rate(step=tf.constant(step, dtype=tf.float32))
 
             if do_log:
                 elapsed_time = time.perf_counter() - start_time  # Off for first log
@@ -421,8 +502,6 @@ def main():
                         dis=dis,
                         ids=val_ids,
                         attention_mask=val_attention_mask,
-                        per_gpu_batch_size=train_args.per_gpu_batch_size,
-                        max_seq_length=data_args.max_seq_length,
                         mask_token_id=tokenizer.mask_token_id,
                     )
                     log_example(
@@ -507,19 +586,34 @@ def main():
                 optimizer_ckpt = os.path.join(
                     path_args.filesystem_prefix,
                     path_args.checkpoint_dir,
-                    f"{run_name}-step{step}-optimizer.npy",
+                    f"{run_name}-step{step}-optimizer.npz",
                 )
                 logger.info(
                     f"Saving discriminator model at {dis_model_ckpt}, generator model at {gen_model_ckpt}, optimizer at {optimizer_ckpt}"
                 )
+                # Save the models synchronously, since the next step would update them mid-write
                 dis.save_weights(dis_model_ckpt)
                 gen.save_weights(gen_model_ckpt)
-                np.save(optimizer_ckpt, optimizer.get_weights())
+                # get_weights() already copies to host, so only writing the copy is deferred.
+                # savez writes each array's raw buffer instead of pickling an object array.
+                if checkpoint_future is not None:
+                    # Surface a failed write now rather than at the end of the run. With one
+                    # worker, the previous checkpoint has almost always finished by now.
+                    checkpoint_future.result()
+                checkpoint_future = checkpoint_executor.submit(
+                    np.savez, optimizer_ckpt, *optimizer.get_weights()
+                )
 
         step += 1
         if is_final_step:
             break
 
+    if hvd.rank() == 0:
+        # Wait for the pending checkpoint, and raise any error from writing it
+        if checkpoint_future is not None:
+            checkpoint_future.result()
+        checkpoint_executor.shutdown()
+
 
 if __name__ == "__main__":
     main()